@@ -21,36 +21,51 @@
 # THE SOFTWARE.
 
 from getopt import getopt
+import io
+import json
 import os
+import re
 import sys
+import time
 
 from builtins import open
 
-libparts = {}
-
 class Log:
-    def __init__(self):
+    def __init__(self, task = 'Verilog generation', failure_status = 1):
+        self.task = task
         self.messages = []
+        # The exit status if the task fails, and if it succeeds. A task can change the
+        # latter, e.g. diff exits with 1 if the netlists are different
+        self.failure_status = failure_status
+        self.success_status = 0
+        # The messages as (severity, message) pairs, where severity is 'error', 'warning' or 'info'
+        self.records = []
         self.errors = 0
         self.warnings = 0
         self.infos = 0
 
     def error(self, s):
         self.messages.append('ERROR: ' + s)
+        self.records.append(('error', s))
         self.errors += 1
 
     def warning(self, s):
         self.messages.append('WARNING: ' + s)
+        self.records.append(('warning', s))
         self.warnings += 1
 
     def info(self, s):
         self.messages.append('INFO: ' + s)
+        self.records.append(('info', s))
         self.infos += 1
 
     def get_messages(self):
         return self.messages + \
             ['{} errors, {} warnings'.format(self.errors, self.warnings), \
-             'Verilog generation ' + ('succeeded!' if self.errors == 0 else 'failed.')]
+             self.task + ' ' + ('succeeded!' if self.errors == 0 else 'failed.')]
+
+    def exit_status(self):
+        return self.failure_status if self.errors else self.success_status
 
 
 # Modify a KiCad name so that it's a valid Verilog identifier
@@ -111,125 +126,824 @@ def wrap(text):
         out.append(text)
     return '\n   '.join(out)
 
+# Verilog keywords. VerilogCode that uses any of them (other than gate primitives) can't be inlined
+_verilog_keywords = set("""
+    always and assign automatic begin buf bufif0 bufif1 case casex casez cell cmos config deassign
+    default defparam design disable edge else end endcase endconfig endfunction endgenerate
+    endmodule endprimitive endspecify endtable endtask event for force forever fork function
+    generate genvar highz0 highz1 if ifnone incdir include initial inout input instance integer
+    join large liblist library localparam macromodule medium module nand negedge nmos nor
+    noshowcancelled not notif0 notif1 or output parameter pmos posedge primitive pull0 pull1
+    pulldown pullup pulsestyle_onevent pulsestyle_ondetect rcmos real realtime reg release
+    repeat rnmos rpmos rtran rtranif0 rtranif1 scalared showcancelled signed small specify
+    specparam strong0 strong1 supply0 supply1 table task time tran tranif0 tranif1 tri tri0 tri1
+    triand trior trireg unsigned use uwire vectored wait wand weak0 weak1 while wire wor xnor xor
+    """.split())
+
+# Gate primitives, which can be instantiated without an instance name
+_verilog_gates = set("""
+    and nand or nor xor xnor buf not bufif0 bufif1 notif0 notif1
+    """.split())
+
+_verilog_token = re.compile(r"""
+    (?P<space>\s+) |
+    (?P<comment>//[^\n]*|/\*.*?\*/) |
+    (?P<number>[0-9]*\s*'[sS]?[bBoOdDhH]\s*[0-9a-fA-F_xXzZ?]+|[0-9][0-9_]*) |
+    (?P<name>[A-Za-z_][A-Za-z0-9_$]*) |
+    (?P<macro>`[A-Za-z_][A-Za-z0-9_$]*) |
+    (?P<punct>[()\[\]{},.;#:?~!&|^+\-*/%<>=])
+    """, re.VERBOSE | re.DOTALL)
+
+# Rewrite a part's VerilogCode so that it can go directly in the top level module.
+# port_args maps the part's port names to the wires connected to them, and bus_macros
+# lists the bus macros (name, port names) that the part's module would define. The
+# code's instance names get the prefix added so they're unique in the top level module.
+# Returns None if the code can't be inlined safely, i.e. unless it's nothing but
+# module instantiations whose arguments only use the part's ports, its bus macros and
+# constants
+def inline_verilog_code(code, port_args, bus_macros, prefix):
+    # Split the code into tokens
+    tokens = []
+    pos = 0
+    while pos < len(code):
+        match = _verilog_token.match(code, pos)
+        if match == None:
+            return None
+        tokens.append([match.lastgroup, match.group()])
+        pos = match.end()
+
+    macro_args = {'`' + name : '{' + ', '.join(port_args[port] for port in ports) + '}'
+                  for name, ports in bus_macros if all(port in port_args for port in ports)}
+
+    # Get the indexes of the tokens that matter, i.e. not spaces or comments
+    significant = [i for i, token in enumerate(tokens) if token[0] not in ('space', 'comment')]
+    if len(significant) == 0:
+        return None
+
+    position = 0
+    def peek():
+        return tokens[significant[position]] if position < len(significant) else [None, None]
+
+    # Skip over a parenthesized list, substituting wires for the ports and bus macros in
+    # it. The names of named connections (e.g. the a in .a(A0)) are left alone. Returns
+    # False if anything else is referenced
+    def argument_list(substitute):
+        nonlocal position
+        depth = 0
+        while True:
+            kind, text = peek()
+            if kind == None:
+                return False
+            if text == '(':
+                depth += 1
+            elif text == ')':
+                depth -= 1
+            elif kind == 'name':
+                previous = tokens[significant[position - 1]][1]
+                if previous != '.':
+                    if not substitute or text not in port_args:
+                        return False
+                    tokens[significant[position]][1] = port_args[text]
+            elif kind == 'macro':
+                if not substitute or text not in macro_args:
+                    return False
+                tokens[significant[position]][1] = macro_args[text]
+            position += 1
+            if depth == 0:
+                return True
+
+    while position < len(significant):
+        # The module being instantiated
+        kind, module = peek()
+        if kind != 'name' or (module in _verilog_keywords and module not in _verilog_gates):
+            return None
+        position += 1
+
+        # Parameters may only be constants
+        if peek()[1] == '#':
+            position += 1
+            if peek()[1] != '(' or not argument_list(False):
+                return None
+
+        # The instance name
+        kind, instance = peek()
+        if kind == 'name' and instance not in _verilog_keywords:
+            tokens[significant[position]][1] = prefix + instance
+            position += 1
+        elif module not in _verilog_gates:
+            return None
+
+        # The port connections
+        if peek()[1] != '(' or not argument_list(True):
+            return None
+        if peek()[1] != ';':
+            return None
+        position += 1
+
+    return '\n'.join('   ' + line.strip() for line in ''.join(text for kind, text in tokens).strip().split('\n'))
+
+# Return the names of the modules that a part's VerilogCode instantiates, not counting gate
+# primitives. A statement is taken to be an instantiation if it starts with a name that's
+# followed by parameters or an instance name
+def instantiated_modules(code):
+    # Split the code into the tokens that matter. Anything the tokenizer doesn't know
+    # (e.g. the quotes of a string, or the $ of a system task) is skipped
+    tokens = []
+    pos = 0
+    while pos < len(code):
+        match = _verilog_token.match(code, pos)
+        if match == None:
+            pos += 1
+            continue
+        if match.lastgroup not in ('space', 'comment'):
+            tokens.append((match.lastgroup, match.group()))
+        pos = match.end()
+
+    modules = []
+    statement_start = True
+    for i, (kind, text) in enumerate(tokens):
+        if statement_start and kind == 'name' and text not in _verilog_keywords and i + 1 < len(tokens):
+            next_kind, next_text = tokens[i + 1]
+            if next_text == '#' or (next_kind == 'name' and next_text not in _verilog_keywords):
+                if text not in modules:
+                    modules.append(text)
+        statement_start = text in (';', 'begin', 'end', 'else', 'generate', 'endgenerate')
+
+    return modules
+
+# Import the parser and netlist object modules. They're imported on first use rather
+# than at load time, because pyparsing is slow to import
+def load_modules():
+    try:
+        from . import kinparse
+    except:
+        import kinparse
+
+    try:
+        from . import NetlistObjects
+    except:
+        import NetlistObjects
+
+    return kinparse, NetlistObjects
+
+# Import the modules and build the netlist grammar ahead of time, e.g. in a background
+# thread while the GUI waits for the user. Any failure is left for main() to report
+def preload():
+    try:
+        kinparse, NetlistObjects = load_modules()
+        kinparse.preload()
+    except Exception:
+        pass
+
+# Compressed file formats we can read and write: their file name extensions and the
+# bytes their files start with
+compressions = {
+    'gzip' : ('.gz', b'\x1f\x8b'),
+    'zstd' : ('.zst', b'\x28\xb5\x2f\xfd')
+    }
+
+# Return the compression format a file name's extension indicates, or None
+def compression_of(file_name):
+    for compression, (extension, magic) in compressions.items():
+        if file_name.lower().endswith(extension):
+            return compression
+    return None
+
+# Return the module that reads and writes a compression format. Raises ImportError if
+# it isn't available (zstd needs Python 3.14, or the zstandard package)
+def compression_module(compression):
+    if compression == 'gzip':
+        import gzip
+        return gzip
+    try:
+        from compression import zstd
+        return zstd
+    except ImportError:
+        import zstandard
+        return zstandard
+
+# Return the compression format of a file, or None if it isn't compressed. It's detected
+# from the first bytes of the file. The extension is only used if they're inconclusive,
+# so e.g. an uncompressed netlist named x.net.gz is still read
+def input_compression(file_name):
+    with open(file_name, 'rb') as raw:
+        start = raw.read(64)
+    for name, (extension, magic) in compressions.items():
+        if start.startswith(magic):
+            return name
+    # A netlist starts with a bracket, so that's clearly not compressed
+    if start.lstrip(b'\xef\xbb\xbf \t\r\n').startswith(b'('):
+        return None
+    return compression_of(file_name)
+
+# Open a text file for reading. If it's compressed, it's decompressed as it's read
+def open_input(file_name, encoding):
+    compression = input_compression(file_name)
+    if compression == None:
+        return open(file_name, 'r', encoding=encoding)
+    return compression_module(compression).open(file_name, 'rt', encoding=encoding)
+
+# Open a text file (or stdout, if file_name is None) for writing, compressing what's written
+# to it if compression is given
+def open_output(file_name, compression = None):
+    if compression == None:
+        return open(file_name, 'w') if file_name != None else sys.stdout
+    return compression_module(compression).open(file_name if file_name != None else sys.stdout.buffer, 'wt')
+
+# Decompress the contents of a file, if they're compressed. They're read as a stream, like
+# a file, since zstandard.decompress() can't handle frames that don't give their size
+# (e.g. from cat x.net | zstd)
+def decompress(data):
+    for compression, (extension, magic) in compressions.items():
+        if data.startswith(magic):
+            with compression_module(compression).open(io.BytesIO(data), 'rb') as stream:
+                return stream.read()
+    return data
+
+# Read the text of a netlist file. Return it, or None (after logging an error) if the file
+# can't be read
+def read_netlist_text(input_file, logging):
+    try:
+        compression = input_compression(input_file)
+        input = open_input(input_file, 'latin_1')
+
+    except ImportError:
+        logging.error('Unable to read ' + input_file + ', because zstd compression is not supported. Install the zstandard package')
+        return None
+
+    except (IOError, EOFError):
+        logging.error('Unable to open ' + input_file + ' for reading.')
+        return None
+
+    try:
+        with input:
+            return input.read()
+
+    except Exception as e:
+        # Each decompressor has its own error class, so catch them all
+        if compression == None:
+            logging.error('Unable to read ' + input_file + '.')
+        else:
+            logging.error('Unable to decompress ' + input_file + '.')
+        logging.error(repr(e))
+        return None
+
+# Parse a netlist file. Return the pyparsing object, or None (after logging an error) if
+# the file can't be read or parsed
+def read_netlist(input_file, logging, jobs = 1):
+    text = read_netlist_text(input_file, logging)
+    if text == None:
+        return None
+
+    return parse_netlist(text, input_file, logging, jobs)
+
+# Parse the text of a netlist. Return the pyparsing object, or None (after logging an
+# error) if it can't be parsed. The name is only used in error messages. jobs is the
+# number of processes to parse large netlists with (0 for one per CPU)
+def parse_netlist(text, name, logging, jobs = 1):
+    try:
+        import pyparsing
+    except:
+        logging.error('Unable to import pyparsing. Click the Help button and see the Installing KiCadVerilog section')
+        return None
+    
+    kinparse, NetlistObjects = load_modules()
+
+    try:
+        return kinparse.parse_netlist(text, jobs = jobs)
+
+    except Exception as e:
+        logging.error('Unable to parse ' + name + ' as a KiCad 6+ netlist.')
+        logging.error(repr(e))
+        return None
+
 ###########################################################################
-# Main program
-def main(argv):
+# Netlist comparison
+def diff(argv):
+    return compare_netlists(argv).get_messages()
+
+# Compare two netlists, and return the Log. Like diff(1), its exit status is 0 if the
+# netlists are equivalent, 1 if they're different, and 2 if they couldn't be compared
+def compare_netlists(argv):
 
-    logging = Log()
+    logging = Log('Netlist comparison', failure_status = 2)
 
-    input_file = None
     output_file = None
     print_help = False
 
     try:
-        options, args = getopt(argv, "i:o:h")
-    except:
-        options = {'-h' : ''}
+        options, args = getopt(argv, "o:h")
+    except Exception as e:
+        logging.error(str(e))
+        options, args = [], []
 
     for option, arg in options:
-        if option == '-i':
-            input_file = arg
-        elif option == '-o':
+        if option == '-o':
             output_file = arg
         elif option == '-h':
             print_help = True
 
-    if print_help or input_file == None:
-        print('Converts a KiCad 6 netlist file into Verilog code.\n')
-        print('Usage: KiCadVerilog.py -i <input file> [-o <output file>] [-h]\n')
+    if print_help or len(args) != 2:
+        # Asking for help isn't an error, but anything else that gets here is
+        if not print_help and logging.errors == 0:
+            logging.error('Two netlists must be given.')
+        print('Lists the differences between two KiCad 6 netlist files.\n')
+        print('Usage: KiCadVerilog.py diff [-o <output file>] [-h] <old netlist> <new netlist>\n')
         print('options:')
         print(' -h                Show this help message and exit.')
-        print(' -i <input file>   Specify the name of the KiCad netlist input file. Required.')
-        print(' -o <output file>  Specify the name of the Verilog output file. Optional.')
+        print(' -o <output file>  Specify the name of the output file. Optional.')
         print('                   If not specified, output will go to stdout.\n')
-        print('See https://github.com/galacticstudios/KiCadVerilog for documentation.')
-        return logging.get_messages()
+        print('Each difference is listed on its own line: + for an added part or net, - for a')
+        print('removed one, and ~ for a modified part or net, or a pin connected to a different')
+        print('net. Timestamps and the order of the netlist are ignored. Nothing is listed if')
+        print('the netlists are equivalent.\n')
+        print('Like diff, the exit status is 0 if the netlists are equivalent, 1 if they are')
+        print('different, and 2 if they couldn\'t be compared.')
+        return logging
+
+    kinparse, NetlistObjects = load_modules()
+
+    # Both netlists usually use the same symbols, so they share a libpart store
+    libpart_store = NetlistObjects.LibpartStore()
+    netlists = []
+    for input_file in args:
+        nlst = read_netlist(input_file, logging)
+        if nlst == None:
+            return logging
+        netlists.append(NetlistObjects.Netlist(nlst, None, libpart_store))
+
+    differences = NetlistObjects.NetlistDiff(netlists[0], netlists[1])
 
     if output_file != None:
         try:
             out = open(output_file, 'w')
         except:
-            logging.error('Unable to open', output_file, 'for writing.')
-            return logging.get_messages()
+            logging.error('Unable to open ' + output_file + ' for writing.')
+            return logging
     else:
         out = sys.stdout
-        
+
+    for line in differences.report():
+        print(line, file = out)
+
+    if out != sys.stdout:
+        out.close()
+
+    if differences.is_empty():
+        logging.info('The netlists are equivalent.')
+    else:
+        logging.info('The netlists are different.')
+        logging.success_status = 1
+
+    return logging
+
+###########################################################################
+# Options for generating Verilog, from the command line
+class Options:
+    def __init__(self, argv = []):
+        self.input_file = None
+        self.output_file = None
+        self.symbol_map_file = None
+        self.libpart_store_file = None
+        self.compression = None
+        self.jobs = 1
+        self.flat = False
+        self.supplies = False
+        self.collapse_supplies = False
+        self.include_paths = []
+        self.dependency_file = None
+        self.include_cache_file = None
+        # The directory that relative include paths, and the output file, are relative to.
+        # None means the current directory
+        self.directory = None
+        self.print_help = False
+
+        try:
+            options, args = getopt(argv, "i:o:m:l:z:j:I:M:C:fsch")
+        except:
+            options = [('-h', '')]
+
+        for option, arg in options:
+            if option == '-i':
+                self.input_file = arg
+            elif option == '-o':
+                self.output_file = arg
+            elif option == '-m':
+                self.symbol_map_file = arg
+            elif option == '-l':
+                self.libpart_store_file = arg
+            elif option == '-z':
+                self.compression = arg
+            elif option == '-j':
+                try:
+                    self.jobs = int(arg)
+                except ValueError:
+                    self.print_help = True
+            elif option == '-I':
+                self.include_paths.append(arg)
+            elif option == '-M':
+                self.dependency_file = arg
+            elif option == '-C':
+                self.include_cache_file = arg
+            elif option == '-f':
+                self.flat = True
+            elif option == '-s':
+                self.supplies = True
+            elif option == '-c':
+                self.supplies = True
+                self.collapse_supplies = True
+            elif option == '-h':
+                self.print_help = True
+
+        # Compress the output if its extension says to
+        if self.compression == None and self.output_file != None:
+            self.compression = compression_of(self.output_file)
+        if self.compression not in [None] + list(compressions.keys()):
+            self.print_help = True
+
+    # Generate a name for the top level Verilog module
+    def top_level_module_name(self, nlst):
+        if self.output_file:
+            output_file = self.output_file
+            if compression_of(output_file) != None:
+                output_file = os.path.splitext(output_file)[0]
+            return os.path.splitext(os.path.basename(output_file.replace('\\\\', '/')))[0]
+        else:
+            return os.path.splitext(os.path.basename(nlst.source.replace('\\\\', '/')))[0]
+
+    # Whether to look for the VerilogInclude files
+    def scan_includes(self):
+        return len(self.include_paths) or self.dependency_file != None or self.include_cache_file != None
+
+def print_usage():
+    print('Converts a KiCad 6 netlist file into Verilog code.\n')
+    print('Usage: KiCadVerilog.py -i <input file> [-o <output file>] [-m <map file>] [-l <store file>]')
+    print('                       [-z <compression>] [-j <jobs>] [-I <dir>] [-M <deps file>]')
+    print('                       [-C <cache file>] [-f] [-s] [-c] [-h]')
+    print('       KiCadVerilog.py diff [-o <output file>] [-h] <old netlist> <new netlist>')
+    print('       KiCadVerilog.py serve [-S <socket>] [-h]')
+    print('       KiCadVerilog.py client [-S <socket>] <options>\n')
+    print('options:')
+    print(' -h                Show this help message and exit.')
+    print(' -i <input file>   Specify the name of the KiCad netlist input file. Required.')
+    print('                   It may be compressed with gzip or zstd.')
+    print(' -o <output file>  Specify the name of the Verilog output file. Optional.')
+    print('                   If not specified, output will go to stdout. If its name ends in')
+    print('                   .gz or .zst, it\'s compressed with gzip or zstd.')
+    print(' -z <compression>  Compress the output with gzip or zstd, whatever its name. Optional.')
+    print(' -j <jobs>         Parse large netlists with this many processes, or 0 for one per')
+    print('                   CPU. Optional. If not specified, one process is used.')
+    print(' -m <map file>     Specify a JSON file mapping library symbols to Verilog fields,')
+    print('                   used by parts that don\'t have those fields. Optional.')
+    print(' -l <store file>   Specify a file to keep library symbol information in, so it can')
+    print('                   be reused by later runs. It\'s created if it doesn\'t exist. Optional.')
+    print(' -I <dir>          Look for VerilogInclude files (and the files they include) in this')
+    print('                   directory, if they aren\'t in the output file\'s directory. May be')
+    print('                   given more than once. Optional.')
+    print(' -M <deps file>    Write a make rule listing the files the output file depends on.')
+    print('                   Optional.')
+    print(' -C <cache file>   Specify a file to keep what\'s in the include files in, so unchanged')
+    print('                   files aren\'t read again. It\'s created if it doesn\'t exist. Optional.')
+    print('                   Missing include files, and modules used by VerilogCode that no')
+    print('                   include file defines, are reported if -I, -M or -C is given.')
+    print(' -f                Generate flat code for simulation: put each part\'s VerilogCode')
+    print('                   directly in the top level module, instead of in a module for')
+    print('                   the part, wherever that can be done safely.')
+    print(' -s                Declare power and ground nets as supply1 and supply0 nets,')
+    print('                   instead of wires with continuous assignments.')
+    print(' -c                Like -s, but also collapse all the power nets into one supply1')
+    print('                   net, and all the ground nets into one supply0 net.\n')
+    print('See https://github.com/galacticstudios/KiCadVerilog for documentation.')
+
+# Open a libpart store file. Return the store, or None (after logging an error) if the file
+# can't be read or parsed
+def read_libpart_store(libpart_store_file, logging):
+    kinparse, NetlistObjects = load_modules()
+
     try:
-        import pyparsing
-    except:
-        logging.error('Unable to import pyparsing. Click the Help button and see the Installing KiCadVerilog section')
-        return logging.get_messages()
-    
+        return NetlistObjects.LibpartStore(libpart_store_file)
+    except IOError:
+        logging.error('Unable to open ' + libpart_store_file + ' for reading.')
+        return None
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        logging.error('Unable to parse ' + libpart_store_file + ' as a libpart store.')
+        logging.error(repr(e))
+        return None
+
+# Read a symbol map file. Return the map, or None (after logging an error) if the file
+# can't be read or parsed
+def read_symbol_map(symbol_map_file, logging):
     try:
-        from . import kinparse
-    except:
-        import kinparse
+        with open(symbol_map_file, 'r', encoding='utf-8') as symbol_map:
+            symbol_fields = json.load(symbol_map)
+        # It has to map symbol names to dictionaries of field names and values
+        if not isinstance(symbol_fields, dict):
+            raise ValueError('The map is not a JSON object')
+        for symbol, fields in symbol_fields.items():
+            if not isinstance(fields, dict):
+                raise ValueError('The fields for ' + symbol + ' are not a JSON object')
+            for name, value in fields.items():
+                if not isinstance(value, str):
+                    raise ValueError('The ' + name + ' field for ' + symbol + ' is not a string')
+        return symbol_fields
+    except IOError:
+        logging.error('Unable to open ' + symbol_map_file + ' for reading.')
+        return None
+    except ValueError as e:
+        logging.error('Unable to parse ' + symbol_map_file + ' as a symbol map.')
+        logging.error(repr(e))
+        return None
+
+###########################################################################
+# Main program
+def main(argv):
+
+    if len(argv) and argv[0] == 'diff':
+        return diff(argv[1:])
+
+    if len(argv) and argv[0] in ['serve', 'client']:
+        try:
+            from . import kvserver
+        except:
+            import kvserver
+        return getattr(kvserver, argv[0])(argv[1:])
+
+    options = Options(argv)
+
+    if options.print_help or options.input_file == None:
+        print_usage()
+        return Log().get_messages()
+
+    result = convert(options.input_file, options)
+    logging = result.log
+
+    if result.generated:
+        try:
+            out = open_output(options.output_file, options.compression)
+        except ImportError:
+            logging.error('Unable to write zstd compressed output. Install the zstandard package')
+            return logging.get_messages()
+        except:
+            logging.error('Unable to open ' + str(options.output_file) + ' for writing.')
+            return logging.get_messages()
+
+        out.write(result.verilog())
+
+        if out != sys.stdout:
+            out.close()
+
+        if options.dependency_file != None:
+            try:
+                with open(options.dependency_file, 'w') as dependency_file:
+                    dependency_file.write(result.dependency_rules(options))
+            except IOError:
+                logging.error('Unable to open ' + options.dependency_file + ' for writing.')
+
+    return logging.get_messages()
+
+###########################################################################
+# Library interface
+
+# The result of converting a netlist to Verilog
+class Result:
+    def __init__(self):
+        self.log = Log()
+        # Whether any Verilog was generated. If not, the log says why
+        self.generated = False
+        # The sections of the generated Verilog: the `include directives, the top level
+        # module, and the modules for the parts
+        self.includes = ''
+        self.top_module = ''
+        self.modules = []
+        # Counts of what was generated, and how long it took (in seconds)
+        self.statistics = {}
+        # The name of the top level module
+        self.module_name = None
+        # The VerilogInclude file names, and the modules that the parts' VerilogCode
+        # instantiates (a dictionary mapping module names to the parts using them)
+        self.verilog_includes = []
+        self.module_references = {}
+        # The include files that were found, as kvincludes.Dependencies, if the options said
+        # to look for them
+        self.dependencies = None
+
+    # Return all the generated Verilog, as it's written to the output file
+    def verilog(self) -> str:
+        return self.includes + self.top_module + '\n' + ''.join(module + '\n' for module in self.modules)
+
+    # Return a make rule saying that the output file (or, if it goes to stdout, a file
+    # named after the top level module) depends on the netlist, the map file and the
+    # include files that were found
+    def dependency_rules(self, options) -> str:
+        try:
+            from . import kvincludes
+        except:
+            import kvincludes
+
+        target = options.output_file if options.output_file != None else self.module_name + '.v'
+        files = [file_name for file_name in [options.input_file, options.symbol_map_file] if file_name != None]
+        if self.dependencies != None:
+            files += self.dependencies.files()
+        return kvincludes.make_rules(target, files)
+
+# Convert a netlist to Verilog in memory, and return a Result. The netlist may be the name
+# of a netlist file, the contents of one (as text, or bytes which may be compressed), or a
+# netlist already parsed by kinparse. options is an Options object; if it's None, the
+# defaults are used. symbol_fields (a symbol map) and libpart_store are used instead of
+# the options' -m and -l files if they're given, and likewise include_cache instead of the
+# -C file. Nothing is written to disk, except the -l and -C files if they're used
+def convert(netlist, options = None, symbol_fields = None, libpart_store = None, include_cache = None) -> Result:
+    if options == None:
+        options = Options()
+
+    result = Result()
+    logging = result.log
+
+    if symbol_fields == None and options.symbol_map_file != None:
+        symbol_fields = read_symbol_map(options.symbol_map_file, logging)
+        if symbol_fields == None:
+            return result
+
+    save_libpart_store = False
+    if libpart_store == None and options.libpart_store_file != None:
+        libpart_store = read_libpart_store(options.libpart_store_file, logging)
+        if libpart_store == None:
+            return result
+        save_libpart_store = True
+
+    start_time = time.perf_counter()
+    if isinstance(netlist, bytes):
+        try:
+            text = decompress(netlist).decode('latin_1')
+        except ImportError:
+            logging.error('Unable to read the netlist, because zstd compression is not supported. Install the zstandard package')
+            return result
+        except Exception as e:
+            logging.error('Unable to decompress the netlist.')
+            logging.error(repr(e))
+            return result
+        nlst = parse_netlist(text, 'the netlist', logging, options.jobs)
+    elif isinstance(netlist, str) and netlist.lstrip().startswith('('):
+        nlst = parse_netlist(netlist, 'the netlist', logging, options.jobs)
+    elif isinstance(netlist, (str, os.PathLike)):
+        nlst = read_netlist(os.fspath(netlist), logging, options.jobs)
+    else:
+        nlst = netlist
+    if nlst is None:
+        return result
+    result.statistics['parse_time'] = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    generate(nlst, result, options.top_level_module_name(nlst), options, symbol_fields, libpart_store)
+    result.statistics['generate_time'] = time.perf_counter() - start_time
 
+    if save_libpart_store:
+        try:
+            libpart_store.save()
+        except IOError:
+            logging.error('Unable to open ' + options.libpart_store_file + ' for writing.')
+
+    if options.scan_includes():
+        start_time = time.perf_counter()
+        resolve_includes(result, options, include_cache)
+        result.statistics['include_time'] = time.perf_counter() - start_time
+
+    return result
+
+# Find the VerilogInclude files, and the files they include, and put them in
+# result.dependencies. Report any that are missing, and any modules used by the parts'
+# VerilogCode that no include file defines
+def resolve_includes(result, options, include_cache = None):
     try:
-        from . import NetlistObjects
+        from . import kvincludes
     except:
-        import NetlistObjects
+        import kvincludes
 
+    logging = result.log
 
-    try:
-        input = open(input_file, 'r', encoding='latin_1')
-        nlst = kinparse.parse_netlist(input)
+    save_include_cache = False
+    if include_cache == None:
+        try:
+            include_cache = kvincludes.IncludeCache(options.include_cache_file)
+        except IOError:
+            logging.error('Unable to open ' + options.include_cache_file + ' for reading.')
+            return
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            logging.error('Unable to parse ' + options.include_cache_file + ' as an include cache.')
+            logging.error(repr(e))
+            return
+        save_include_cache = True
 
-    except IOError:
-        logging.error('Unable to open ' + input_file + ' for reading.')
-        return logging.get_messages()
+    # Includes are looked for relative to the output file first
+    directory = options.directory if options.directory != None else ''
+    base_dir = os.path.join(directory, os.path.dirname(options.output_file or ''))
+    include_paths = [os.path.join(directory, include_path) for include_path in options.include_paths]
 
-    except Exception as e:
-        logging.error('Unable to parse ' + input_file + ' as a KiCad 6+ netlist.')
-        logging.error(repr(e))
-        return logging.get_messages()
+    dependencies = kvincludes.scan(result.verilog_includes, base_dir, include_paths, include_cache)
+    for file_name, including_file in dependencies.missing:
+        if including_file == None:
+            logging.warning('Include file ' + file_name + ' was not found.')
+        else:
+            logging.warning('Include file ' + file_name + ', included by ' + including_file + ', was not found.')
 
-    # Generate a name for the top level Verilog module
-    if output_file:
-        top_level_module_name = os.path.splitext(os.path.basename(output_file.replace('\\\\', '/')))[0]
-    else:
-        top_level_module_name = os.path.splitext(os.path.basename(nlst.source.replace('\\\\', '/')))[0]
+    for module, part_refs in sorted(result.module_references.items()):
+        if module not in dependencies.modules:
+            logging.warning('Module ' + module + ', used by ' + ', '.join(part_refs) + ', is not defined in any include file.')
+
+    result.dependencies = dependencies
+    result.statistics['include_files'] = len(dependencies.graph)
+
+    if save_include_cache:
+        try:
+            include_cache.save()
+        except IOError:
+            logging.error('Unable to open ' + options.include_cache_file + ' for writing.')
+
+# Generate Verilog code for a parsed netlist, and put it in result
+def generate(nlst, result, top_level_module_name, options, symbol_fields = None, libpart_store = None):
+
+    kinparse, NetlistObjects = load_modules()
+
+    logging = result.log
+    statistics = result.statistics
 
     # Build objects for the netlist
-    netlist = NetlistObjects.Netlist(nlst)
+    netlist = NetlistObjects.Netlist(nlst, symbol_fields, libpart_store)
 
     # Get all the VerilogInclude files
     verilog_includes = netlist.verilog_includes()
+    result.verilog_includes = verilog_includes
+    result.module_name = top_level_module_name
     
     # Get the nets that should be specified as top-level module ports
     verilog_module_ports = netlist.verilog_module_ports()
                         
     # Generate `include directives for all the Verilog include files we found
+    out = io.StringIO()
     for include_file in verilog_includes:
         print('`include "' + include_file + '"', file = out)
     print('', file = out)
+    result.includes = out.getvalue()
+    statistics['includes'] = len(verilog_includes)
+
+    # Generate the top level module
+    out = io.StringIO()
 
     module_signature = 'module ' + top_level_module_name
 
     wire_definitions = ''
     module_ports = []
 
-    # Go through all the nets, generating wires for them
+    # Work out what signal to generate for each net. Normally it's just the net's name. But
+    # if we're collapsing supplies, all the power nets that aren't module ports become one
+    # signal, named after the first of them, and likewise all the ground nets
+    signal_names = {}
     for net_name, net in netlist.nets.items():
+        signal_names[net_name] = legal_verilog_name(net.name)
+    if options.collapse_supplies:
+        for is_rail in [NetlistObjects.Net.is_power_net, NetlistObjects.Net.is_ground_net]:
+            rail = [net_name for net_name, net in netlist.nets.items()
+                    if verilog_module_ports.get(net_name) == None and is_rail(net)]
+            if len(rail):
+                rail_signal = min(signal_names[net_name] for net_name in rail)
+                for net_name in rail:
+                    signal_names[net_name] = rail_signal
+
+    # Go through all the nets in order of their signal names, generating wires for them
+    declared = set()
+    for net_name, net in sorted(netlist.nets.items(), key = lambda item : (signal_names[item[0]], item[0])):
+        signal = signal_names[net_name]
+
         # If this net is supposed to be a module port
         module_port_type = verilog_module_ports.get(net_name)
         if module_port_type != None:
-            module_ports.append(verilog_pin_type(module_port_type) + ' ' + legal_verilog_name(net.name))
+            module_ports.append(verilog_pin_type(module_port_type) + ' ' + signal)
             
+        # Else if we've already generated a wire for this signal (i.e. it's a collapsed supply)
+        elif signal in declared:
+            pass
+
         # Else (this net is not a module port) generate a wire for it
         else:
+            declared.add(signal)
             if net.is_power_net():
-                wire_definitions += '   wire ' + legal_verilog_name(net.name) + ';\n'
-                wire_definitions += '   assign ' + legal_verilog_name(net.name) + ' = 1;\n'
+                if options.supplies:
+                    wire_definitions += '   supply1 ' + signal + ';\n'
+                else:
+                    wire_definitions += '   wire ' + signal + ';\n'
+                    wire_definitions += '   assign ' + signal + ' = 1;\n'
             elif net.is_ground_net():
-                wire_definitions += '   wire ' + legal_verilog_name(net.name) + ';\n'
-                wire_definitions += '   assign ' + legal_verilog_name(net.name) + ' = 0;\n'
+                if options.supplies:
+                    wire_definitions += '   supply0 ' + signal + ';\n'
+                else:
+                    wire_definitions += '   wire ' + signal + ';\n'
+                    wire_definitions += '   assign ' + signal + ' = 0;\n'
             elif net.pulled == 0:
-                wire_definitions += '   tri0 ' + legal_verilog_name(net.name) + ';\n'
+                wire_definitions += '   tri0 ' + signal + ';\n'
             elif net.pulled == 1:
-                wire_definitions += '   tri1 ' + legal_verilog_name(net.name) + ';\n'
+                wire_definitions += '   tri1 ' + signal + ';\n'
             else:
-                wire_definitions += '   wire ' + legal_verilog_name(net.name) + ';\n'
+                wire_definitions += '   wire ' + signal + ';\n'
 
     print(module_signature, file = out)
     if len(module_ports):
@@ -243,6 +957,8 @@ def main(argv):
     # Generate modules for each of the parts. Also build a dictionary for each module,
     # of which pins are ports
     modules_code = []
+    module_references = {}
+    inlined = 0
     part_refs = list(netlist.parts.keys())
     part_refs.sort(key = lambda item : NetlistObjects.SortableReference(item))
     for part_ref in part_refs:
@@ -262,53 +978,69 @@ def main(argv):
 
         # Generate the pin declarations
         ports = []
+        port_names = []
         for pin in pins:
             # If this isn't a power pin
             if pin.type.find('power') == -1:
                 # Make the pin an argument to the module
-                ports.append('   ' + verilog_pin_type(pin.type) + ' ' + legal_verilog_name(part.unique_names[pin.num]))
-                net = pin.get('net')
-                if net != None:
-                    invocation_args.append(legal_verilog_name(pin['net'].name))
+                port_names.append(legal_verilog_name(part.unique_names[pin.num]))
+                ports.append('   ' + verilog_pin_type(pin.type) + ' ' + port_names[-1])
+                if pin.net != None:
+                    invocation_args.append(signal_names[pin.net.name])
                 else:
                     invocation_args.append(legal_verilog_name("1'bz"))
                     logging.warning('Pin ' + pin.num + ' on part ' + part.ref + ' is not connected to a net, and is not marked as \'no-connect\'')
 
         if len(ports):
-            # Generate the module declaration
-            module_code = 'module ' + module_name + '(\n' + ',\n'.join(ports) + ');\n\n'
-
             # Create vectors for any buses. The user can use them if he wants, or ignore them otherwise
-            newline = ''
-            first_macro = True
-            undefs = []
-            for bus_name, bus_pins in part.buses.items():
+            bus_macros = []
+            for bus_name, bus_pins in sorted(part.buses.items()):
                 # If this is a bus with only one pin in it, don't generate a vector for it
                 if len(bus_pins) <= 1:
-                    break
+                    continue
 
                 # Sort the pins by their bus index (e.g. A15, A14, A13, A12...)
-                args = sorted(bus_pins, key = lambda p: p[2].number, reverse = True)
+                args = sorted(bus_pins, key = lambda p: (p[1], p[0]), reverse = True)
                 # Build a list of the ports in the vector
                 arg_list = []
                 for arg in args:
-                    arg_list.append(legal_verilog_name(part.unique_names[arg[1].num]))
-                # Define a macro that collects bus pins into a vector. Undefine it later
-                vbus_name = legal_verilog_name(bus_name)
-                if first_macro:
-                    module_code += '   // NOTE: The following symbols are MACRO definition(s)!\n'
-                    module_code += '   // To use them, precede them with a `\n'
-                    first_macro = False
-                module_code += '   `define {} {{{}}}\n'.format(vbus_name, ', '.join(arg_list))
-                undefs.append('   `undef {}'.format(vbus_name))
-                newline = '\n'
-
-            module_code += newline
+                    arg_list.append(legal_verilog_name(part.unique_names[arg[0]]))
+                bus_macros.append((legal_verilog_name(bus_name), arg_list))
 
-            # Put any Verilog code in the module
             verilog_code = part.verilog_code()
             if verilog_code != None:
-                module_code += verilog_code.encode('utf-8').decode('unicode_escape')
+                for module in instantiated_modules(verilog_code):
+                    module_references.setdefault(module, []).append(part.ref)
+
+            # In flat mode, put the part's Verilog code straight into the top level module
+            # if we can, instead of wrapping it in a module
+            if options.flat and verilog_code != None:
+                inline_code = inline_verilog_code(verilog_code, dict(zip(port_names, invocation_args)),
+                                                  bus_macros, '_' + legal_verilog_name(part.ref) + '_')
+                if inline_code != None:
+                    print('   // ' + part.ref, file = out)
+                    print(inline_code + '\n', file = out)
+                    inlined += 1
+                    continue
+
+                logging.info('Module ' + module_name + ' was not inlined because its Verilog code is not a list of module instantiations on its ports.')
+
+            # Generate the module declaration
+            module_code = 'module ' + module_name + '(\n' + ',\n'.join(ports) + ');\n\n'
+
+            # Define a macro for each bus that collects the bus pins into a vector. Undefine it later
+            undefs = []
+            if len(bus_macros):
+                module_code += '   // NOTE: The following symbols are MACRO definition(s)!\n'
+                module_code += '   // To use them, precede them with a `\n'
+                for vbus_name, arg_list in bus_macros:
+                    module_code += '   `define {} {{{}}}\n'.format(vbus_name, ', '.join(arg_list))
+                    undefs.append('   `undef {}'.format(vbus_name))
+                module_code += '\n'
+
+            # Put any Verilog code in the module
+            if verilog_code != None:
+                module_code += verilog_code
                 module_code += '\n\n'
 
             # else if there's no Verilog code for this module
@@ -331,17 +1063,36 @@ def main(argv):
 
     # Finish the main module
     print('\nendmodule\n', file = out)
+    result.top_module = out.getvalue()
 
-    # Output the modules' code
-    print('', file = out)
-    for module_code in modules_code:
-        print(module_code, file = out)
+    result.modules = modules_code
+    result.generated = True
 
-    out.close()
+    # The parts' own modules are defined here, rather than in an include file
+    generated_modules = set(verilog_module_name(part) for part in netlist.parts.values())
+    result.module_references = {module : part_refs for module, part_refs in module_references.items()
+                                if module not in generated_modules}
 
-    return logging.get_messages()
+    statistics['parts'] = len(netlist.parts)
+    statistics['nets'] = len(netlist.nets)
+    statistics['wires'] = len(declared)
+    statistics['modules'] = len(modules_code)
+    statistics['inlined'] = inlined
 
 
 if __name__ == '__main__':
-    from kvgui import launch
-    launch()
+    # With no arguments, run the GUI. Otherwise, run from the command line
+    if len(sys.argv) > 1:
+        if sys.argv[1] == 'diff':
+            logging = compare_netlists(sys.argv[2:])
+            messages = logging.get_messages()
+            status = logging.exit_status()
+        else:
+            messages = main(sys.argv[1:])
+            status = 0 if messages[-1].endswith('succeeded!') else 1
+        for message in messages:
+            print(message, file = sys.stderr)
+        sys.exit(status)
+    else:
+        from kvgui import launch
+        launch()
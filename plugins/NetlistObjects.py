@@ -1,6 +1,10 @@
+import hashlib
+import json
 import logging
+import os
 from functools import total_ordering
 import re
+import threading
 
 # Take a reference (e.g. R1, U20, etc.) and split it into the letters and
 # number. Allow it to be sorted by the letters first, then the integer
@@ -28,63 +32,207 @@ class SortableReference:
         else:
             return False
 
+# Case-insensitive lookup of a part's fields. If a field isn't found, the lookup falls
+# through to the parent index, so a part can inherit fields from its library symbol,
+# which in turn can inherit them from a symbol mapping file
+class FieldIndex:
+    def __init__(self, values, parent = None):
+        self._values = {}
+        for name, value in values:
+            # If a field appears more than once, the first one wins
+            self._values.setdefault(name.lower(), value)
+        self._parent = parent
+        self._decoded = {}
+
+    # Build an index from the (field (name ...) value) clauses of a component or libpart
+    @staticmethod
+    def from_fields(fields, parent = None):
+        return FieldIndex([(field.name, field.value) for field in fields], parent)
+
+    # Return the value of a field, or None if neither this index nor its parents has it
+    def get(self, name, inherit = True):
+        value = self._values.get(name)
+        if value == None and inherit and self._parent != None:
+            return self._parent.get(name)
+        return value
+
+    # Return the value of a field with its escape sequences (e.g. \n) decoded. Escapes are
+    # decoded twice, as KiCadVerilog always has, so that e.g. \\n in the field also becomes a
+    # newline. The decoded value is cached on the index that defines the field, so code
+    # defined once per symbol is only decoded once, no matter how many parts use it
+    def get_decoded(self, name):
+        value = self._values.get(name)
+        if value == None:
+            if self._parent != None:
+                return self._parent.get_decoded(name)
+            return None
+        decoded = self._decoded.get(name)
+        if decoded == None:
+            decoded = value.encode('raw_unicode_escape').decode('unicode_escape')
+            decoded = decoded.encode('utf-8').decode('unicode_escape')
+            self._decoded[name] = decoded
+        return decoded
+
+    # Return a sorted list of (name, value) for all the fields in this index and its
+    # parents, with the ones here overriding the parents'
+    def resolved(self):
+        values = dict(self._parent.resolved()) if self._parent != None else {}
+        values.update(self._values)
+        return sorted(values.items())
+
+# Hash a list of values (strings, and lists or tuples of them) in a way that's stable
+# from run to run
+def canonical_hash(*values) -> str:
+    return hashlib.sha1(repr(values).encode('utf-8')).hexdigest()
+
+# The information about a library symbol that every part using it needs: its pins, unique
+# names for them, and the buses they form. It's computed once per symbol, and can be kept
+# in a LibpartStore to reuse it in later runs
+class Symbol:
+    def __init__(self, lib, name, desc, pins):
+        self.lib = lib
+        self.name = name
+        self.desc = desc
+        # A list of (pin number, name, type)
+        self.pins = pins
+        # A dictionary mapping pin numbers to unique pin names
+        self.unique_names = {}
+        # A dictionary mapping bus names to lists of (pin number, index in the bus)
+        self.buses = {}
+
+        # Look for duplicate names. We'll need to mangle them to make them unique
+        seen = set()
+        duplicates = set()
+        for num, pin_name, type in pins:
+            if pin_name in seen:
+                duplicates.add(pin_name)
+            else:
+                seen.add(pin_name)
+
+            # Split out any number at the end of the name.
+            # e.g. A0, A1, A2... will get split into A and the number
+            # We do this to identify buses
+            split = SortableReference(pin_name)
+            # If the name has a number at the end and text at the beginning
+            if split.number != None and split.ref != '':
+                # Build a list of pins whose names start with the same letter(s) and have
+                # numbers at the end. I.e. buses
+                bus = self.buses.get(split.ref)
+                if bus == None:
+                    self.buses[split.ref] = [(num, split.number)]
+                else:
+                    bus.append((num, split.number))
+
+        # Go through the pins and give them unique names
+        for num, pin_name, type in pins:
+            if pin_name in duplicates:
+                self.unique_names[num] = pin_name + '_' + num
+            else:
+                self.unique_names[num] = pin_name
+
+    # Return the key a libpart's symbol is stored under. It includes a hash of the libpart's
+    # pins and description, so a symbol that changed in the library isn't reused
+    @staticmethod
+    def key(libpart):
+        return libpart.lib + ':' + libpart.name + ':' + canonical_hash(libpart.desc,
+                              [(pin.num, pin.name, pin.type) for pin in libpart.pins])
+
+    @staticmethod
+    def from_libpart(libpart):
+        return Symbol(libpart.lib, libpart.name, libpart.desc,
+                      [(pin.num, pin.name, pin.type) for pin in libpart.pins])
+
+    def to_json(self):
+        return {'lib' : self.lib, 'name' : self.name, 'desc' : self.desc, 'pins' : self.pins,
+                'unique_names' : self.unique_names, 'buses' : self.buses}
+
+    @staticmethod
+    def from_json(values):
+        symbol = Symbol.__new__(Symbol)
+        symbol.lib = values['lib']
+        symbol.name = values['name']
+        symbol.desc = values['desc']
+        symbol.pins = [tuple(pin) for pin in values['pins']]
+        symbol.unique_names = values['unique_names']
+        symbol.buses = {bus_name : [tuple(pin) for pin in bus_pins] for bus_name, bus_pins in values['buses'].items()}
+        return symbol
+
+# Symbols, keyed by library, name and contents, so they can be shared by all the parts
+# and netlists that use them. If the store has a file, it's loaded from and saved to it,
+# so symbols are only computed once across runs
+class LibpartStore:
+    def __init__(self, path = None):
+        self.path = path
+        self.symbols = {}
+        self.modified = False
+        self._lock = threading.Lock()
+
+        if path != None and os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as store:
+                symbols = json.load(store)
+            if not isinstance(symbols, dict):
+                raise ValueError(path + ' is not a JSON object')
+            for key, values in symbols.items():
+                self.symbols[key] = Symbol.from_json(values)
+
+    # Return the Symbol for a libpart, computing it if it isn't in the store
+    def symbol(self, libpart) -> Symbol:
+        key = Symbol.key(libpart)
+        with self._lock:
+            symbol = self.symbols.get(key)
+            if symbol == None:
+                symbol = self.symbols[key] = Symbol.from_libpart(libpart)
+                self.modified = True
+            return symbol
+
+    # Save the store to its file, if anything was added to it
+    def save(self):
+        with self._lock:
+            if self.path != None and self.modified:
+                with open(self.path, 'w', encoding='utf-8') as store:
+                    json.dump({key : symbol.to_json() for key, symbol in self.symbols.items()}, store)
+                self.modified = False
+
+class Pin:
+    def __init__(self, num, name, type):
+        self.num = num
+        self.name = name
+        self.type = type
+        self.net = None
+
 class Part:
     
-    def __init__(self, part, libparts):
+    def __init__(self, part, symbol, symbol_fields = None):
         self._part = part
+        self._fields = FieldIndex.from_fields(part.fields, symbol_fields)
+        self._symbol = symbol
         self.pins = {}
-        self.unique_names = {}
         self.name = part.name
         self.ref = part.ref
 
-        # Save a reference to our libpart
-        for libpart in libparts:
-            duplicates = set()
-            if (part.lib == libpart.lib and part.name == libpart.name):
-                self._libpart = libpart
-                seen = set()
-                self.buses = {}
-                for pin in libpart.pins:
-                    # Build a list of the pins on this part.
-                    self.pins[pin.num] = pincopy = pin.copy()
-                    # Look for duplicate names. We'll need to mangle them later to make them unique
-                    if pincopy.name in seen:
-                        duplicates.add(pincopy.name)
-                    else:
-                        seen.add(pincopy.name)
-
-                    # Split out any number at the end of the name.
-                    # e.g. A0, A1, A2... will get split into A and the number
-                    # We do this to identify buses
-                    split = SortableReference(pincopy.name)
-                    # If the name has a number at the end and text at the beginning
-                    if split.number != None and split.ref != '':
-                        # Build a list of pins whose names start with the same letter(s) and have
-                        # numbers at the end. I.e. buses
-                        bus = self.buses.get(split.ref)
-                        if bus == None:
-                            self.buses[split.ref] = [(str(pincopy.num), pincopy, split)]
-                        else:
-                            bus.append((str(pincopy.num), pincopy, split))
+        # If we don't have the part's library symbol, we don't know anything about its pins
+        if symbol == None:
+            self.desc = ''
+            self.unique_names = {}
+            self.buses = {}
+            return
 
-                break
-
-        # Go through the pins and give them unique names
-        for pin in self.pins.values():
-            if pin.name in duplicates:
-                self.unique_names[pin.num] = pin.name + '_' + pin.num
-            else:
-                self.unique_names[pin.num] = pin.name
+        self.desc = symbol.desc
+        self.unique_names = symbol.unique_names
+        self.buses = symbol.buses
+        # Build a list of the pins on this part.
+        for num, pin_name, type in symbol.pins:
+            self.pins[num] = Pin(num, pin_name, type)
 
     def add_net(self, pin_number, net):
         pin = self.pins.get(str(pin_number))
         if (pin != None):
-            pin['net'] = net
+            pin.net = net
 
     def nets(self):
         nets = []
         for pin in self.pins.values():
-            net = pin.get('net')
+            net = pin.net
             if net != None:
                 nets.append(net)
         return nets
@@ -97,85 +245,88 @@ class Part:
 
     def is_pulldown_resistor(self) -> bool:
         gndCount = 0
-        if len(self.pins) == 2 and self._libpart.desc.lower().find('resistor') != -1:
+        if len(self.pins) == 2 and self.desc.lower().find('resistor') != -1:
             for pin in self.pins.values():
-                net = pin.get('net')
+                net = pin.net
                 if net != None and net.is_ground_net():
                     gndCount += 1
         return gndCount == 1
 
     def _mark_pulldown_net(self):
         for pin in self.pins.values():
-            net = pin.get('net')
+            net = pin.net
             if net != None and not net.is_ground_net():
                 net.set_pulled_down()
                 break
 
     def is_pullup_resistor(self) -> bool:
         pwrCount = 0
-        if len(self.pins) == 2 and self._libpart.desc.lower().find('resistor') != -1:
+        if len(self.pins) == 2 and self.desc.lower().find('resistor') != -1:
             for pin in self.pins.values():
-                net = pin.get('net')
+                net = pin.net
                 if net != None and net.is_power_net():
                     pwrCount += 1
         return pwrCount == 1
 
     def _mark_pullup_net(self):
         for pin in self.pins.values():
-            net = pin.get('net')
-            if net != None and not pin.net.is_power_net():
+            net = pin.net
+            if net != None and not net.is_power_net():
                 net.set_pulled_up()
                 break
 
     def is_bypass_cap(self) -> bool:
         pwrCount = 0
         gndCount = 0
-        if len(self.pins) == 2 and self._libpart.desc.lower().find('capacitor') != -1:
+        if len(self.pins) == 2 and self.desc.lower().find('capacitor') != -1:
             for pin in self.pins.values():
-                net = pin.get('net')
+                net = pin.net
                 if net.is_power_net():
                     pwrCount += 1
                 if net.is_ground_net():
                     gndCount += 1
         return pwrCount == 1 and gndCount == 1
 
-    def _verilog_include(self) -> str:
-        for field in self._part.fields:
-            # If this field specifies an include file
-            if field.name.lower() == 'veriloginclude':
-                return field.value
-
-        return None;
+    # Return a hash of the part's contents, including its library symbol's description and
+    # pins, and the fields it inherits from the symbol and the symbol map. Timestamps are
+    # left out, since KiCad rewrites them every time it exports the netlist
+    def content_hash(self) -> str:
+        part = self._part
+        symbol = self._symbol
+        return canonical_hash(part.ref, part.value, part.lib, part.name, part.footprint,
+                              part.datasheet, part.sheetpath.names if part.sheetpath else '',
+                              sorted((field.name, field.value) for field in part.fields),
+                              sorted((prop.name, prop.value) for prop in part.properties),
+                              symbol.desc if symbol != None else None,
+                              symbol.pins if symbol != None else None,
+                              self._fields.resolved())
 
+    def _verilog_include(self) -> str:
+        return self._fields.get('veriloginclude')
 
     def verilog_code(self) -> str:
-        for field in self._part.fields:
-            # If this field specifies an include file
-            if field.name.lower() == 'verilogcode':
-                return field.value.encode('raw_unicode_escape').decode('unicode_escape')
-
-        return None;
+        return self._fields.get_decoded('verilogcode')
 
     # Return a dictionary of net names that are connected to this part, and which should be used
     # as top-level module ports (as determined by the VerilogModulePort field). They are mapped
     # to the Verilog pin type (input, output, inout)
     def _verilog_module_ports(self):
         ports = {}
-        for field in self._part.fields:
-            # If this field specifies an include file
-            if field.name.lower() == 'verilogmoduleport':
-                # Split apart a comma-separated list
-                pin_list = field.value.split(',')
-                # Go through each pin number in the list
-                for pin_str in pin_list:
-                    pin_num = pin_str.strip()
-
-                    pin = self.pins.get(pin_num)
-                    if pin == None:
-                        logging.error('Error: in part ' + self._part.ref + ', the VerilogModulePort field has the invalid pin number "' + pin + '"')
-
-                    else:
-                        ports[pin.net.net.name] = pin.type
+        # Module ports are specific to this part, so they're not inherited from the symbol
+        module_ports = self._fields.get('verilogmoduleport', inherit = False)
+        if module_ports != None:
+            # Split apart a comma-separated list
+            pin_list = module_ports.split(',')
+            # Go through each pin number in the list
+            for pin_str in pin_list:
+                pin_num = pin_str.strip()
+
+                pin = self.pins.get(pin_num)
+                if pin == None:
+                    logging.error('Error: in part ' + self._part.ref + ', the VerilogModulePort field has the invalid pin number "' + pin_num + '"')
+
+                else:
+                    ports[pin.net.name] = pin.type
 
         return ports
 
@@ -199,12 +350,38 @@ class Net:
     def set_pulled_up(self):
         self.pulled = 1
 
+    # Return a hash of the pins connected to the net. It doesn't depend on the order
+    # of the pins in the netlist
+    def content_hash(self) -> str:
+        return canonical_hash(self.name, sorted((pin.ref, pin.num) for pin in self.net.pins))
+
 class Netlist:
-    def __init__(self, nlst):
+    # symbol_fields optionally maps library symbols ('lib:part', or just 'part') to a dictionary
+    # of fields. They're used for parts that don't define those fields in the schematic
+    # libpart_store optionally holds symbols from previous netlists, to reuse here
+    def __init__(self, nlst, symbol_fields = None, libpart_store = None):
+        if libpart_store == None:
+            libpart_store = LibpartStore()
+
+        # Get the symbol for each libpart, and build a field index for it. Both are shared
+        # by all the parts that use the libpart
+        symbols = {}
+        field_indexes = {}
+        for libpart in nlst.libparts:
+            symbols[(libpart.lib, libpart.name)] = libpart_store.symbol(libpart)
+
+            mapped = None
+            if symbol_fields != None:
+                values = symbol_fields.get(libpart.lib + ':' + libpart.name, symbol_fields.get(libpart.name))
+                if values != None:
+                    mapped = FieldIndex(values.items())
+            field_indexes[(libpart.lib, libpart.name)] = FieldIndex.from_fields(libpart.fields, mapped)
+
         # Build a dictionary mapping part refs to Parts
         self.parts = {}
         for part in nlst.parts:
-            self.parts[part.ref] = Part(part, nlst.libparts)
+            self.parts[part.ref] = Part(part, symbols.get((part.lib, part.name)),
+                                        field_indexes.get((part.lib, part.name)))
 
         # Build a dictionary mapping net names to Nets
         self.nets = {}
@@ -219,21 +396,22 @@ class Netlist:
                 if (part != None):
                     part.add_net(pin.num, obj_net)
 
-            # Go through all the parts
-            for part in self.parts.values():
-                # If it's a pullup resistor
-                if part.is_pullup_resistor():
-                    part._mark_pullup_net()
-                elif part.is_pulldown_resistor():
-                    part._mark_pulldown_net()
-
-    def verilog_includes(self) -> set[str]:
+        # Now that all the nets are connected, go through all the parts
+        for part in self.parts.values():
+            # If it's a pullup resistor
+            if part.is_pullup_resistor():
+                part._mark_pullup_net()
+            elif part.is_pulldown_resistor():
+                part._mark_pulldown_net()
+
+    # Return a sorted list of the VerilogInclude files, without duplicates
+    def verilog_includes(self) -> list[str]:
         includes = set()
         for part in self.parts.values():
             part_include = part._verilog_include()
             if part_include != None:
                 includes.add(part_include)
-        return includes
+        return sorted(includes)
 
     # Return a dictionary of net names which should be used as top-level module ports 
     # (as determined by the VerilogModulePort field in each part). They are mapped
@@ -245,3 +423,65 @@ class Netlist:
             nets = dict(nets, **n)
 
         return nets
+
+    # Return a dictionary mapping (part ref, pin number) to the name of the net
+    # connected to that pin
+    def pin_nets(self):
+        pins = {}
+        for net in self.nets.values():
+            for pin in net.net.pins:
+                pins[(pin.ref, pin.num)] = net.name
+        return pins
+
+# The differences between two netlists. Parts are matched by reference and nets by
+# name; they're compared by their content hashes, so anything KiCad rewrites on every
+# export (timestamps, dates, the order of sections) doesn't show up as a change
+class NetlistDiff:
+    def __init__(self, old, new):
+        self.added_parts, self.removed_parts, self.modified_parts = \
+            _diff_hashes(_part_hashes(old), _part_hashes(new), SortableReference)
+        self.added_nets, self.removed_nets, self.modified_nets = \
+            _diff_hashes(_net_hashes(old), _net_hashes(new), None)
+
+        # Find the pins whose net changed, as (part ref, pin number, old net, new net)
+        self.rewired_pins = []
+        old_pins = old.pin_nets()
+        new_pins = new.pin_nets()
+        for pin in set(old_pins) | set(new_pins):
+            old_net = old_pins.get(pin)
+            new_net = new_pins.get(pin)
+            if old_net != new_net:
+                self.rewired_pins.append((pin[0], pin[1], old_net, new_net))
+        self.rewired_pins.sort(key = lambda item : (SortableReference(item[0]), item[1]))
+
+    def is_empty(self) -> bool:
+        return not (self.added_parts or self.removed_parts or self.modified_parts or
+                    self.added_nets or self.removed_nets or self.modified_nets or
+                    self.rewired_pins)
+
+    # Return the differences as lines of text
+    def report(self):
+        lines = []
+        for prefix, kind, names in [('+', 'part', self.added_parts), ('-', 'part', self.removed_parts),
+                                    ('~', 'part', self.modified_parts), ('+', 'net', self.added_nets),
+                                    ('-', 'net', self.removed_nets), ('~', 'net', self.modified_nets)]:
+            for name in names:
+                lines.append('{} {} {}'.format(prefix, kind, name))
+        for ref, num, old_net, new_net in self.rewired_pins:
+            lines.append('~ pin {}.{}: {} -> {}'.format(ref, num,
+                         old_net if old_net != None else '(none)', new_net if new_net != None else '(none)'))
+        return lines
+
+def _part_hashes(netlist):
+    return {ref : part.content_hash() for ref, part in netlist.parts.items()}
+
+def _net_hashes(netlist):
+    return {name : net.content_hash() for name, net in netlist.nets.items()}
+
+# Compare two dictionaries of name -> hash. Return lists of the added, removed
+# and modified names, sorted with the given key
+def _diff_hashes(old, new, key):
+    added = [name for name in new if name not in old]
+    removed = [name for name in old if name not in new]
+    modified = [name for name in new if name in old and old[name] != new[name]]
+    return tuple(sorted(names, key = key) for names in (added, removed, modified))
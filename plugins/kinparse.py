@@ -27,16 +27,29 @@ Parsers for netlist files of various formats (only KiCad, at present).
 
 
 from builtins import open
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import os
+import re
+import threading
 
 from pyparsing import *
 
 
 THIS_MODULE = locals()
 
+# Grammars are expensive to build, so each one is built once and reused.
+_parsers = {}
+_parsers_lock = threading.Lock()
 
-def _parse_netlist_kicad(text):
+# pyparsing parsers aren't safe to use from several threads at once.
+_parse_lock = threading.Lock()
+
+
+def _build_parser_kicad():
     """
-    Return a pyparsing object storing the contents of a KiCad netlist.
+    Return pyparsing parsers for the contents of a KiCad netlist, and for
+    runs of the clauses in its components and nets sections.
     """
 
     def _paren_clause(keyword, subclause):
@@ -138,16 +151,163 @@ def _parse_netlist_kicad(text):
                 (design & components & Optional(libparts) & Optional(libraries) & nets
                 )) + end_of_file.suppress()
 
-    return parser.parseString(text)
+    return {
+        'netlist': parser,
+        'components': ZeroOrMore(comp) + end_of_file.suppress(),
+        'nets': ZeroOrMore(net) + end_of_file.suppress(),
+    }
+
+
+def _get_parser(tool, section='netlist'):
+    """
+    Return the parser for a tool's netlists (or a section of them), building
+    it on first use.
+    """
+
+    with _parsers_lock:
+        parsers = _parsers.get(tool)
+        if parsers is None:
+            parsers = THIS_MODULE['_build_parser_{}'.format(tool)]()
+            _parsers[tool] = parsers
+        return parsers[section]
+
+
+# Sections whose clauses are independent of each other, and so can be parsed in shards.
+_SHARDED_SECTIONS = ('components', 'nets')
+
+# Don't bother sharding sections with fewer clauses than this in each shard.
+_MIN_SHARD_CLAUSES = 200
+
+# Double-quoted strings (which may contain parentheses) and parentheses.
+_brackets = re.compile(r'"(?:[^"\\]|\\.)*"|[()]')
+_keyword = re.compile(r'\s*([A-Za-z_]+)')
+
+
+def _find_clauses(text, sections):
+    """
+    Find the named sections of a netlist, and the clauses in them, with a
+    bracket scan.
+
+    Returns:
+        A dictionary mapping each section found to a tuple of its (start, end)
+        and a list of the (start, end) of each of its clauses.
+    """
+
+    found = {}
+    depth = 0
+    section = None
+    for match in _brackets.finditer(text):
+        token = match.group()
+        if token == '(':
+            depth += 1
+            if depth == 2:
+                keyword = _keyword.match(text, match.end())
+                section = keyword.group(1).lower() if keyword else None
+                if section in sections:
+                    found[section] = [match.start(), []]
+                else:
+                    section = None
+            elif depth == 3 and section is not None:
+                clause_start = match.start()
+        elif token == ')':
+            if depth == 3 and section is not None:
+                found[section][1].append((clause_start, match.end()))
+            elif depth == 2 and section is not None:
+                found[section][0] = (found[section][0], match.end())
+                section = None
+            depth -= 1
+    # Leave out any section that wasn't closed; parsing will report the error.
+    return {name: tuple(spans) for name, spans in found.items() if isinstance(spans[0], tuple)}
+
+
+def _parse_shard(tool, section, text):
+    """
+    Parse a run of clauses from a section of a netlist. This runs in a
+    worker process.
+    """
+
+    return _get_parser(tool, section).parseString(text)
+
+
+def _parse_sharded(tool, text, jobs):
+    """
+    Parse a netlist, splitting its components and nets sections into shards
+    that are parsed in a pool of processes. Returns the same structure as
+    parsing the netlist in one piece.
+    """
+
+    sections = _find_clauses(text, _SHARDED_SECTIONS)
+
+    # Small netlists aren't worth starting processes for.
+    if all(len(clauses) < _MIN_SHARD_CLAUSES for span, clauses in sections.values()):
+        parser = _get_parser(tool)
+        with _parse_lock:
+            return parser.parseString(text)
+
+    # Cut the sections out of the netlist, leaving them empty.
+    remainder = text
+    for name, (span, clauses) in sorted(sections.items(), key=lambda item: item[1][0], reverse=True):
+        remainder = remainder[:span[0]] + '({})'.format(name) + remainder[span[1]:]
+
+    # The processes are spawned rather than forked, since the conversion server parses
+    # netlists in threads, and forking a process with threads can deadlock.
+    with ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context('spawn')) as pool:
+        # Split each section into shards of consecutive clauses.
+        futures = {}
+        for name, (span, clauses) in sections.items():
+            size = max(_MIN_SHARD_CLAUSES, -(-len(clauses) // jobs))
+            futures[name] = [
+                pool.submit(_parse_shard, tool, name, text[clauses[i][0]:clauses[min(i + size, len(clauses)) - 1][1]])
+                for i in range(0, len(clauses), size)
+            ]
+
+        # Parse the rest of the netlist while the shards are being parsed.
+        parser = _get_parser(tool)
+        with _parse_lock:
+            netlist = parser.parseString(remainder)
+
+        # Put the shards back together, in their original order.
+        for name, results_name in (('components', 'parts'), ('nets', 'nets')):
+            if name in futures:
+                merged = ParseResults([])
+                for future in futures[name]:
+                    merged += future.result()
+                netlist[results_name] = merged
+
+    return netlist
+
+
+def _parse_netlist_kicad(text, jobs=1):
+    """
+    Return a pyparsing object storing the contents of a KiCad netlist.
+    """
+
+    if jobs > 1:
+        return _parse_sharded('kicad', text, jobs)
+
+    parser = _get_parser('kicad')
+    with _parse_lock:
+        return parser.parseString(text)
+
+
+def preload(tool='kicad'):
+    """
+    Build the netlist parser for a tool ahead of time so the first call
+    to parse_netlist() doesn't have to wait for it.
+    """
+
+    _get_parser(tool)
 
 
-def parse_netlist(src, tool='kicad'):
+def parse_netlist(src, tool='kicad', jobs=1):
     """
     Return a pyparsing object storing the contents of a netlist.
 
     Args:
         src: Either a text string, or a filename, or a file object that stores
             the netlist.
+        jobs: The number of processes to parse the netlist's components and
+            nets sections with. 0 means one per CPU.
 
     Returns:
         A pyparsing object that stores the netlist contents.
@@ -171,7 +331,7 @@ def parse_netlist(src, tool='kicad'):
         # Use the tool name to find the function for loading the library.
         func_name = '_parse_netlist_{}'.format(tool)
         parse_func = THIS_MODULE[func_name]
-        return parse_func(text)
+        return parse_func(text, jobs or os.cpu_count() or 1)
     except KeyError:
         # OK, that didn't work so well...
         logger.error('Unsupported ECAD tool library: {}'.format(tool))
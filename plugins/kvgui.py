@@ -11,14 +11,23 @@ import wx
 
 # begin wxGlade: extracode
 import os.path
-try:
-    from . import KiCadVerilog
-except:
-    import KiCadVerilog
-
+import threading
 import webbrowser
 
+# KiCadVerilog is imported on demand so that the dialog opens with only wx loaded
+def kicadverilog():
+    try:
+        from . import KiCadVerilog
+    except:
+        import KiCadVerilog
+    return KiCadVerilog
+
+# Load the parser in the background while the user fills in the dialog
+def preload():
+    kicadverilog().preload()
+
 def launch():
+    threading.Thread(target=preload, daemon=True).start()
     kvapp = KVApp(0)
     kvapp.MainLoop()
 # end wxGlade
@@ -121,9 +130,9 @@ class KVUI(wx.Dialog):
             with wx.BusyCursor():
                 self.results_text.SetValue('')
                 try:
-                    log = KiCadVerilog.main(['-i', self.netlist_file_field.GetValue(), '-o', self.verilog_file_field.GetValue()])
+                    log = kicadverilog().main(['-i', self.netlist_file_field.GetValue(), '-o', self.verilog_file_field.GetValue()])
                 except Exception as e:
-                    log = str(e)
+                    log = [str(e)]
 
                 for message in log:
                     self.results_text.write(message + '\n')
@@ -148,5 +157,6 @@ class KVApp(wx.App):
 # end of class KVApp
 
 if __name__ == "__main__":
+    threading.Thread(target=preload, daemon=True).start()
     kvapp = KVApp(0)
     kvapp.MainLoop()
@@ -0,0 +1,152 @@
+import hashlib
+import json
+import os
+import re
+import threading
+
+_comment = re.compile(r'//[^\n]*|/\*.*?\*/', re.DOTALL)
+_include = re.compile(r'`include\s+"([^"]+)"')
+_module = re.compile(r'\b(?:module|macromodule)\s+([A-Za-z_][A-Za-z0-9_$]*)')
+
+# What an include file contains: the files it `includes and the modules it defines. It's
+# identified by the file's modification time and size, and the hash of its contents
+class IncludeFile:
+    def __init__(self, mtime, size, hash, includes, modules):
+        self.mtime = mtime
+        self.size = size
+        self.hash = hash
+        self.includes = includes
+        self.modules = modules
+
+    @staticmethod
+    def from_text(mtime, size, hash, text):
+        text = _comment.sub('', text)
+        return IncludeFile(mtime, size, hash, _include.findall(text), _module.findall(text))
+
+    def to_json(self):
+        return {'mtime' : self.mtime, 'size' : self.size, 'hash' : self.hash,
+                'includes' : self.includes, 'modules' : self.modules}
+
+    @staticmethod
+    def from_json(values):
+        return IncludeFile(values['mtime'], values['size'], values['hash'], values['includes'], values['modules'])
+
+# The contents of include files, keyed by path. A file is only read again if its
+# modification time or size changed, and only scanned again if its contents changed. If
+# the cache has a file, it's loaded from and saved to it, so unchanged files aren't read
+# again on later runs
+class IncludeCache:
+    def __init__(self, path = None):
+        self.path = path
+        self.files = {}
+        self.modified = False
+        self._lock = threading.Lock()
+
+        if path != None and os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as cache:
+                files = json.load(cache)
+            if not isinstance(files, dict):
+                raise ValueError(path + ' is not a JSON object')
+            for file_name, values in files.items():
+                self.files[file_name] = IncludeFile.from_json(values)
+
+    # Return the IncludeFile for a file. Raises OSError if it can't be read
+    def get(self, file_name) -> IncludeFile:
+        stat = os.stat(file_name)
+        with self._lock:
+            cached = self.files.get(file_name)
+        if cached != None and cached.mtime == stat.st_mtime_ns and cached.size == stat.st_size:
+            return cached
+
+        with open(file_name, 'rb') as include:
+            data = include.read()
+        hash = hashlib.sha1(data).hexdigest()
+        if cached != None and cached.hash == hash:
+            include_file = IncludeFile(stat.st_mtime_ns, stat.st_size, hash, cached.includes, cached.modules)
+        else:
+            include_file = IncludeFile.from_text(stat.st_mtime_ns, stat.st_size, hash, data.decode('latin_1'))
+
+        with self._lock:
+            self.files[file_name] = include_file
+            self.modified = True
+        return include_file
+
+    # Save the cache to its file, if anything changed
+    def save(self):
+        with self._lock:
+            if self.path != None and self.modified:
+                with open(self.path, 'w', encoding='utf-8') as cache:
+                    json.dump({file_name : include_file.to_json() for file_name, include_file in self.files.items()}, cache)
+                self.modified = False
+
+# The include files a design depends on
+class Dependencies:
+    def __init__(self):
+        # A dictionary mapping the path of each include file found to the paths of the
+        # files it includes
+        self.graph = {}
+        # The includes that weren't found, as (file name, path of the file including it,
+        # or None for a VerilogInclude field)
+        self.missing = []
+        # The modules defined in the include files
+        self.modules = set()
+
+    # Return the paths of all the include files, sorted
+    def files(self):
+        return sorted(self.graph.keys())
+
+# Find the file an include refers to. Files are looked for in the directory of the file
+# including them (if any), then the base directory, then the include paths. Returns the
+# path, or None if it isn't found
+def resolve(file_name, including_dir, base_dir, include_paths):
+    if os.path.isabs(file_name):
+        return file_name if os.path.isfile(file_name) else None
+
+    directories = ([including_dir] if including_dir != None else []) + [base_dir] + include_paths
+    for directory in directories:
+        path = os.path.normpath(os.path.join(directory, file_name))
+        if os.path.isfile(path):
+            return path
+    return None
+
+# Find the include files (and the ones they include, and so on) for a list of VerilogInclude
+# file names, and return their Dependencies
+def scan(verilog_includes, base_dir, include_paths, cache):
+    dependencies = Dependencies()
+
+    # Each entry is (file name, path of the file including it)
+    pending = [(file_name, None) for file_name in verilog_includes]
+    while len(pending):
+        file_name, including_file = pending.pop(0)
+        including_dir = os.path.dirname(including_file) if including_file != None else None
+        path = resolve(file_name, including_dir, base_dir, include_paths)
+        if path == None:
+            dependencies.missing.append((file_name, including_file))
+            continue
+        if including_file != None:
+            dependencies.graph[including_file].append(path)
+        if path in dependencies.graph:
+            continue
+
+        try:
+            include_file = cache.get(path)
+        except OSError:
+            dependencies.missing.append((file_name, including_file))
+            continue
+
+        dependencies.graph[path] = []
+        dependencies.modules.update(include_file.modules)
+        pending.extend((nested, path) for nested in include_file.includes)
+
+    return dependencies
+
+# Return make rules saying that target depends on the files. Each file also gets an
+# empty rule, so make doesn't fail if it's deleted
+def make_rules(target, files):
+    def escape(file_name):
+        return file_name.replace(' ', '\\ ')
+
+    rules = escape(target) + ':' + ''.join(' \\\n  ' + escape(file_name) for file_name in files) + '\n'
+    for file_name in files:
+        rules += '\n' + escape(file_name) + ':\n'
+    return rules
@@ -0,0 +1,369 @@
+import hashlib
+import json
+import os
+import signal
+import socket
+import socketserver
+import stat
+import struct
+import sys
+import tempfile
+import threading
+from collections import OrderedDict
+from getopt import getopt
+
+try:
+    from . import KiCadVerilog
+except:
+    import KiCadVerilog
+
+try:
+    from . import kvincludes
+except:
+    import kvincludes
+
+# Return the socket the server listens on, if none is specified. It's in a directory only
+# the user can use, so other users can't put their own server there: $XDG_RUNTIME_DIR, or
+# else a directory in the temporary directory named after the user's id
+def default_socket():
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir:
+        return os.path.join(runtime_dir, 'kicadverilog.sock')
+    return os.path.join(tempfile.gettempdir(), 'kicadverilog-' + str(_uid()), 'kicadverilog.sock')
+
+# Return the user's id, or their name on platforms without user ids
+def _uid():
+    if hasattr(os, 'getuid'):
+        return os.getuid()
+    import getpass
+    return getpass.getuser()
+
+DEFAULT_SOCKET = default_socket()
+
+# Check that the directory of a socket belongs to the user, and that nobody else can use it,
+# creating it if create is True. Returns an error message, or None if it's safe
+def check_socket_directory(socket_path, create):
+    directory = os.path.dirname(socket_path)
+    if create:
+        try:
+            os.mkdir(directory, 0o700)
+        except FileExistsError:
+            pass
+        except OSError as e:
+            return 'Unable to create ' + directory + ': ' + str(e)
+
+    try:
+        info = os.lstat(directory)
+    except OSError as e:
+        return 'Unable to use ' + directory + ': ' + str(e)
+    if not stat.S_ISDIR(info.st_mode) or info.st_mode & 0o077 or \
+       (hasattr(os, 'getuid') and info.st_uid != os.getuid()):
+        return directory + ' must be a directory that belongs to you, and that only you can use.'
+    return None
+
+# Return the user id of the process at the other end of a Unix socket connection, or None
+# if the platform can't tell
+def peer_uid(connection):
+    if not hasattr(socket, 'SO_PEERCRED'):
+        return None
+    credentials = connection.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+    pid, uid, gid = struct.unpack('3i', credentials)
+    return uid
+
+# How many parsed netlists the server keeps in memory
+PARSE_CACHE_SIZE = 16
+
+# Parsed netlists, keyed by a hash of their text, so that converting the same netlist
+# again (e.g. with different options) doesn't parse it again. The least recently used
+# netlists are discarded when the cache is full. If several requests need the same
+# netlist at once, only the first one parses it, and the others wait for it
+class ParseCache:
+    def __init__(self, size = PARSE_CACHE_SIZE):
+        self.size = size
+        self.entries = OrderedDict()
+        # Locks for the netlists being parsed, keyed like the entries
+        self.parsing = {}
+        self.lock = threading.Lock()
+
+    # Return a cached netlist, or None. The lock must be held
+    def _lookup(self, key):
+        nlst = self.entries.get(key)
+        if nlst is not None:
+            self.entries.move_to_end(key)
+        return nlst
+
+    # Return the parsed netlist, or None (after logging an error) if it can't be parsed
+    def parse(self, text, name, logging, jobs = 1):
+        key = hashlib.sha1(text.encode('utf-8')).hexdigest()
+        with self.lock:
+            nlst = self._lookup(key)
+            if nlst is not None:
+                return nlst
+            parse_lock = self.parsing.setdefault(key, threading.Lock())
+
+        with parse_lock:
+            # Another request may have parsed it while this one waited
+            with self.lock:
+                nlst = self._lookup(key)
+            if nlst is None:
+                nlst = KiCadVerilog.parse_netlist(text, name, logging, jobs)
+
+            with self.lock:
+                if nlst is not None:
+                    self.entries[key] = nlst
+                    while len(self.entries) > self.size:
+                        self.entries.popitem(last = False)
+                if self.parsing.get(key) is parse_lock:
+                    del self.parsing[key]
+        return nlst
+
+# Handles a connection to the server. Each request is a line of JSON:
+#   {"args": [command line options], "cwd": directory, "netlist": netlist text}
+# "args" are the same options KiCadVerilog.py takes, and relative file names in them are
+# relative to "cwd". "netlist" is optional; if it's given, it's converted instead of the
+# -i file. The server's own libpart store and include cache are used instead of any -l
+# or -C file. Each response is a line of JSON:
+#   {"verilog": generated code, or null, "log": [messages], "errors": n, "warnings": n,
+#    "records": [[severity, message]], "statistics": {name: value},
+#    "dependencies": the -M file's make rule, or null}
+# "records" has the same messages as "log", without the summary, as (severity, message)
+# pairs like Log.records
+class ConversionHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+            except ValueError:
+                request = None
+            response = self.server.convert(request)
+            self.wfile.write((json.dumps(response) + '\n').encode('utf-8'))
+            self.wfile.flush()
+
+class ConversionServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    address_family = getattr(socket, 'AF_UNIX', None)
+    daemon_threads = True
+
+    def __init__(self, socket_path, libpart_store):
+        self.parse_cache = ParseCache()
+        self.libpart_store = libpart_store
+        self.include_cache = kvincludes.IncludeCache()
+        socketserver.TCPServer.__init__(self, socket_path, ConversionHandler)
+
+    def convert(self, request):
+        result, options = self._convert(request)
+        logging = result.log
+        dependencies = None
+        if result.generated and options.dependency_file != None:
+            dependencies = result.dependency_rules(options)
+        return {'verilog' : result.verilog() if result.generated else None, 'log' : logging.get_messages(),
+                'errors' : logging.errors, 'warnings' : logging.warnings, 'records' : logging.records,
+                'statistics' : result.statistics,
+                'dependencies' : dependencies}
+
+    # Convert a netlist. Returns a KiCadVerilog.Result, and the KiCadVerilog.Options used
+    def _convert(self, request):
+        result = KiCadVerilog.Result()
+        logging = result.log
+        options = KiCadVerilog.Options()
+
+        if not isinstance(request, dict):
+            logging.error('Invalid request.')
+            return result, options
+
+        cwd = request.get('cwd', '')
+        options = KiCadVerilog.Options(request.get('args', []))
+        text = request.get('netlist')
+        if options.print_help or (options.input_file == None and text == None):
+            logging.error('No netlist was given.')
+            return result, options
+
+        if options.symbol_map_file != None:
+            options.symbol_map_file = os.path.join(cwd, options.symbol_map_file)
+        options.libpart_store_file = None
+        options.include_cache_file = None
+        options.directory = cwd
+
+        if text == None:
+            input_file = os.path.join(cwd, options.input_file)
+            text = KiCadVerilog.read_netlist_text(input_file, logging)
+            if text == None:
+                return result, options
+            name = input_file
+        else:
+            name = 'the netlist'
+
+        nlst = self.parse_cache.parse(text, name, logging, options.jobs)
+        if nlst is None:
+            return result, options
+
+        return KiCadVerilog.convert(nlst, options, libpart_store = self.libpart_store,
+                                    include_cache = self.include_cache), options
+
+###########################################################################
+# Run the conversion server
+def serve(argv):
+
+    logging = KiCadVerilog.Log('Conversion server')
+
+    socket_path = DEFAULT_SOCKET
+    libpart_store_file = None
+    print_help = False
+
+    try:
+        options, args = getopt(argv, "S:l:h")
+    except:
+        options = [('-h', '')]
+
+    for option, arg in options:
+        if option == '-S':
+            socket_path = arg
+        elif option == '-l':
+            libpart_store_file = arg
+        elif option == '-h':
+            print_help = True
+
+    if print_help:
+        print('Runs a server that converts KiCad 6 netlist files into Verilog code.\n')
+        print('Usage: KiCadVerilog.py serve [-S <socket>] [-l <store file>] [-h]\n')
+        print('options:')
+        print(' -h                Show this help message and exit.')
+        print(' -S <socket>       Specify the Unix socket to listen on. Optional.')
+        print('                   If not specified, ' + DEFAULT_SOCKET + ' is used.')
+        print(' -l <store file>   Specify a file to load library symbol information from, and to')
+        print('                   save it to when the server stops. Optional.\n')
+        print('The server keeps the netlist parser, library symbols and recently parsed netlists')
+        print('in memory, and handles requests concurrently. Use KiCadVerilog.py client to send')
+        print('it requests.')
+        return logging.get_messages()
+
+    if ConversionServer.address_family == None:
+        logging.error('Unix sockets are not supported on this platform.')
+        return logging.get_messages()
+
+    if socket_path == DEFAULT_SOCKET:
+        error = check_socket_directory(socket_path, True)
+        if error != None:
+            logging.error(error)
+            return logging.get_messages()
+
+    # Remove the socket left behind by a previous server, but not a file that isn't a
+    # socket, or the socket of a server that's still running
+    if os.path.exists(socket_path):
+        if not stat.S_ISSOCK(os.stat(socket_path).st_mode):
+            logging.error(socket_path + ' exists and is not a socket.')
+            return logging.get_messages()
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+                connection.connect(socket_path)
+            logging.error('A server is already listening on ' + socket_path + '.')
+            return logging.get_messages()
+        except ConnectionRefusedError:
+            os.remove(socket_path)
+        except OSError as e:
+            logging.error('Unable to check ' + socket_path + ': ' + str(e))
+            return logging.get_messages()
+
+    KiCadVerilog.preload()
+
+    if libpart_store_file != None:
+        libpart_store = KiCadVerilog.read_libpart_store(libpart_store_file, logging)
+        if libpart_store == None:
+            return logging.get_messages()
+    else:
+        kinparse, NetlistObjects = KiCadVerilog.load_modules()
+        libpart_store = NetlistObjects.LibpartStore()
+
+    try:
+        server = ConversionServer(socket_path, libpart_store)
+    except OSError as e:
+        logging.error('Unable to listen on ' + socket_path + ': ' + str(e))
+        return logging.get_messages()
+
+    # Stop cleanly when terminated, as well as on Ctrl-C
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, stop)
+
+    print('Listening on ' + socket_path, file = sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(socket_path)
+
+    try:
+        libpart_store.save()
+    except IOError:
+        logging.error('Unable to open ' + libpart_store_file + ' for writing.')
+
+    return logging.get_messages()
+
+###########################################################################
+# Send a conversion request to the server
+def client(argv):
+
+    logging = KiCadVerilog.Log()
+
+    # The socket has to be the first option, since the rest are passed on to the server
+    socket_path = DEFAULT_SOCKET
+    if len(argv) >= 2 and argv[0] == '-S':
+        socket_path = argv[1]
+        argv = argv[2:]
+
+    options = KiCadVerilog.Options(argv)
+    if options.print_help or options.input_file == None:
+        print('Converts a KiCad 6 netlist file into Verilog code, using a conversion server.\n')
+        print('Usage: KiCadVerilog.py client [-S <socket>] <options>\n')
+        print('options:')
+        print(' -S <socket>       Specify the Unix socket the server is listening on. Optional.')
+        print('                   If not specified, ' + DEFAULT_SOCKET + ' is used.')
+        print('                   It must come before any other options.\n')
+        print('The other options are the same as KiCadVerilog.py\'s. Run KiCadVerilog.py -h to')
+        print('see them.')
+        return logging.get_messages()
+
+    if socket_path == DEFAULT_SOCKET:
+        error = check_socket_directory(socket_path, False)
+        if error != None:
+            logging.error(error)
+            return logging.get_messages()
+
+    request = {'args' : argv, 'cwd' : os.getcwd()}
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+            connection.connect(socket_path)
+            # Don't send our files to, or take output from, another user's server
+            uid = peer_uid(connection)
+            if uid != None and uid != os.getuid():
+                logging.error('The conversion server at ' + socket_path + ' belongs to another user.')
+                return logging.get_messages()
+            connection.sendall((json.dumps(request) + '\n').encode('utf-8'))
+            response = json.loads(connection.makefile('rb').readline())
+    except (AttributeError, OSError, ValueError) as e:
+        logging.error('Unable to get a response from the conversion server at ' + socket_path + ': ' + repr(e))
+        return logging.get_messages()
+
+    if response['verilog'] != None:
+        try:
+            out = KiCadVerilog.open_output(options.output_file, options.compression)
+        except ImportError:
+            logging.error('Unable to write zstd compressed output. Install the zstandard package')
+            return logging.get_messages()
+        except:
+            logging.error('Unable to open ' + str(options.output_file) + ' for writing.')
+            return logging.get_messages()
+        out.write(response['verilog'])
+        if out != sys.stdout:
+            out.close()
+
+    if response.get('dependencies') != None:
+        try:
+            with open(options.dependency_file, 'w') as dependency_file:
+                dependency_file.write(response['dependencies'])
+        except IOError:
+            logging.error('Unable to open ' + options.dependency_file + ' for writing.')
+            return logging.get_messages()
+
+    return response['log']
@@ -0,0 +1,34 @@
+`include "7402.v"
+`include "counter.v"
+`include "lib7402.v"
+
+module board
+(
+   input _CLK
+);
+
+
+   supply0 GND;
+   supply1 VCC;
+   tri1 _IN;
+   wire _Q0;
+   wire _Q1;
+   wire _Q2;
+   tri0 _Q3;
+   wire _Y1;
+   wire _Y2;
+
+
+   // U1
+   ttl_7402 _U1_g(_IN, _Q0, _Y1);
+
+   // U2
+   nor _U2_n(_Y2, _IN, _Q1);
+
+   // U3
+   counter4 _U3_c(.q({_Q3, _Q2, _Q1, _Q0}), .clk(_CLK));
+
+
+endmodule
+
+
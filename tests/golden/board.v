@@ -0,0 +1,82 @@
+`include "7402.v"
+`include "counter.v"
+`include "lib7402.v"
+
+module board
+(
+   input _CLK
+);
+
+
+   wire GND;
+   assign GND = 0;
+   wire VCC;
+   assign VCC = 1;
+   tri1 _IN;
+   wire _Q0;
+   wire _Q1;
+   wire _Q2;
+   tri0 _Q3;
+   wire _Y1;
+   wire _Y2;
+   wire plus5V;
+   assign plus5V = 1;
+
+
+   U1 _U1(_IN, _Q0, _Y1);
+
+   U2 _U2(_IN, _Q1, _Y2);
+
+   U3 _U3(_Q0, _Q1, _Q2, _Q3, _CLK);
+
+
+endmodule
+
+
+module U1(
+   input A0,
+   input A1,
+   output Y);
+
+   // NOTE: The following symbols are MACRO definition(s)!
+   // To use them, precede them with a `
+   `define A {A1, A0}
+
+ttl_7402 g(A0, A1, Y);
+
+   `undef A
+
+endmodule
+
+module U2(
+   input A0,
+   input A1,
+   output Y);
+
+   // NOTE: The following symbols are MACRO definition(s)!
+   // To use them, precede them with a `
+   `define A {A1, A0}
+
+nor n(Y, A0, A1);
+
+   `undef A
+
+endmodule
+
+module U3(
+   output Q0,
+   output Q1,
+   output Q2,
+   output Q3,
+   input CLK);
+
+   // NOTE: The following symbols are MACRO definition(s)!
+   // To use them, precede them with a `
+   `define Q {Q3, Q2, Q1, Q0}
+
+counter4 c(.q(`Q), .clk(CLK));
+
+   `undef Q
+
+endmodule
+
@@ -0,0 +1,94 @@
+# Golden output tests: converting the same netlist must always give the same bytes, whatever
+# the hash seed and whatever order KiCad writes the netlist's sections in
+
+import os
+import random
+import subprocess
+import sys
+
+import pytest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+PLUGINS_DIR = os.path.join(os.path.dirname(TESTS_DIR), 'plugins')
+GOLDEN_DIR = os.path.join(TESTS_DIR, 'golden')
+
+sys.path.insert(0, PLUGINS_DIR)
+import KiCadVerilog
+
+# Each case is (netlist, options, expected output)
+CASES = [
+    ('board.net', [], 'board.v'),
+    ('board.net', ['-f', '-c'], 'board-flat-c.v'),
+]
+
+HASH_SEEDS = ['0', '1', '4242', 'random']
+
+def read_golden(file_name):
+    with open(os.path.join(GOLDEN_DIR, file_name), 'rb') as golden:
+        return golden.read()
+
+def convert(text, options):
+    result = KiCadVerilog.convert(text, KiCadVerilog.Options(options))
+    assert result.generated, result.log.get_messages()
+    return result.verilog().encode('utf-8')
+
+# Return the (start, end) of each clause in a section of a netlist, e.g. each comp in
+# components. Quoted strings are skipped, since VerilogCode often has brackets in it
+def section_clauses(text, section):
+    start = text.index('(' + section)
+    clauses = []
+    depth = 0
+    pos = start
+    while True:
+        char = text[pos]
+        if char == '"':
+            pos = text.index('"', pos + 1)
+            while text[pos - 1] == '\\':
+                pos = text.index('"', pos + 1)
+        elif char == '(':
+            depth += 1
+            if depth == 2:
+                clause_start = pos
+        elif char == ')':
+            depth -= 1
+            if depth == 1:
+                clauses.append((clause_start, pos + 1))
+            elif depth == 0:
+                return clauses
+        pos += 1
+
+# Shuffle the clauses in the components, libparts and nets sections of a netlist
+def shuffle_netlist(text, rng):
+    for section in ['components', 'libparts', 'nets']:
+        clauses = section_clauses(text, section)
+        pieces = [text[start : end] for start, end in clauses]
+        rng.shuffle(pieces)
+        separator = text[clauses[0][1] : clauses[1][0]]
+        text = text[: clauses[0][0]] + separator.join(pieces) + text[clauses[-1][1] :]
+    return text
+
+@pytest.mark.parametrize('netlist, options, expected', CASES)
+def test_matches_golden(netlist, options, expected):
+    with open(os.path.join(GOLDEN_DIR, netlist), 'r', encoding='latin_1') as input:
+        text = input.read()
+    assert convert(text, options) == read_golden(expected)
+
+@pytest.mark.parametrize('netlist, options, expected', CASES)
+@pytest.mark.parametrize('seed', HASH_SEEDS)
+def test_independent_of_hash_seed(netlist, options, expected, seed):
+    script = ('import sys, KiCadVerilog\n'
+              'result = KiCadVerilog.convert(sys.argv[1], KiCadVerilog.Options(sys.argv[2:]))\n'
+              'sys.stdout.buffer.write(result.verilog().encode("utf-8"))\n')
+    env = dict(os.environ, PYTHONHASHSEED = seed, PYTHONPATH = PLUGINS_DIR)
+    output = subprocess.run([sys.executable, '-c', script, os.path.join(GOLDEN_DIR, netlist)] + options,
+                            env = env, stdout = subprocess.PIPE, check = True).stdout
+    assert output == read_golden(expected)
+
+@pytest.mark.parametrize('netlist, options, expected', CASES)
+@pytest.mark.parametrize('seed', range(5))
+def test_independent_of_netlist_order(netlist, options, expected, seed):
+    with open(os.path.join(GOLDEN_DIR, netlist), 'r', encoding='latin_1') as input:
+        text = input.read()
+    shuffled = shuffle_netlist(text, random.Random(seed))
+    assert shuffled != text
+    assert convert(shuffled, options) == read_golden(expected)
@@ -0,0 +1,66 @@
+# Sharded parsing tests: a netlist big enough to be split into shards must convert to the
+# same Verilog with several processes as with one
+
+import os
+import sys
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+PLUGINS_DIR = os.path.join(os.path.dirname(TESTS_DIR), 'plugins')
+
+sys.path.insert(0, PLUGINS_DIR)
+import KiCadVerilog
+import kinparse
+
+# Enough parts that, with two jobs, the components and nets sections are each split into
+# more than one shard
+PART_COUNT = 2 * kinparse._MIN_SHARD_CLAUSES + 1
+
+# VerilogCode with brackets and escaped quotes in it, which the bracket scan that splits
+# the netlist into shards has to skip over
+VERILOG_CODE = r'buf b(Y, A); // an escaped \"(\" and an unmatched ( bracket'
+
+# Build a netlist with a chain of buffers, each driving the next one's input
+def build_netlist(part_count):
+    components = []
+    nets = []
+    for i in range(1, part_count + 1):
+        components.append('    (comp (ref "U{0}")\n'
+                          '      (value "Buffer")\n'
+                          '      (fields\n'
+                          '        (field (name "VerilogCode") "{1}"))\n'
+                          '      (libsource (lib "Custom") (part "Buffer") (description "Buffer (1 gate)"))\n'
+                          '      (sheetpath (names "/") (tstamps "/"))\n'
+                          '      (tstamps "{0:08d}"))'.format(i, VERILOG_CODE))
+        nets.append('    (net (code "{0}") (name "/N{0}")\n'
+                    '      (node (ref "U{0}") (pin "2") (pintype "output"))\n'
+                    '      (node (ref "U{1}") (pin "1") (pintype "input")))'.format(i, i % part_count + 1))
+
+    return ('(export (version "E")\n'
+            '  (design\n'
+            '    (source "/home/user/chain/chain.kicad_sch")\n'
+            '    (tool "Eeschema 6.0.0"))\n'
+            '  (components\n' + '\n'.join(components) + ')\n'
+            '  (libparts\n'
+            '    (libpart (lib "Custom") (part "Buffer")\n'
+            '      (description "Buffer (1 gate)")\n'
+            '      (fields\n'
+            '        (field (name "Reference") "U"))\n'
+            '      (pins\n'
+            '        (pin (num "1") (name "A") (type "input"))\n'
+            '        (pin (num "2") (name "Y") (type "output")))))\n'
+            '  (nets\n' + '\n'.join(nets) + '))\n')
+
+def test_sharded_parse_matches_serial_parse():
+    text = build_netlist(PART_COUNT)
+
+    sections = kinparse._find_clauses(text, kinparse._SHARDED_SECTIONS)
+    assert len(sections['components'][1]) == PART_COUNT
+    assert len(sections['nets'][1]) == PART_COUNT
+
+    serial = KiCadVerilog.convert(text, KiCadVerilog.Options(['-j', '1']))
+    sharded = KiCadVerilog.convert(text, KiCadVerilog.Options(['-j', '2']))
+    assert serial.generated, serial.log.get_messages()
+    assert sharded.generated, sharded.log.get_messages()
+    assert sharded.statistics['parts'] == PART_COUNT
+    assert sharded.verilog() == serial.verilog()
+    assert 'an escaped "(" and an unmatched ( bracket' in sharded.verilog()
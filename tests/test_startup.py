@@ -0,0 +1,86 @@
+# Startup tests: import each module in plugins in a fresh interpreter, record how long it
+# takes, and check that the modules on the plugin's startup path don't pull in the parser
+
+import ast
+import glob
+import importlib.util
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+PLUGINS_DIR = os.path.join(os.path.dirname(TESTS_DIR), 'plugins')
+
+MODULES = sorted(os.path.splitext(os.path.basename(path))[0]
+                 for path in glob.glob(os.path.join(PLUGINS_DIR, '*.py'))
+                 if os.path.basename(path) != '__init__.py')
+
+# Modules that need packages only KiCad provides
+REQUIRES = {
+    'kvgui' : 'wx',
+    'kicadverilog_action' : 'pcbnew',
+}
+
+# The parser and the netlist model, which are slow to import and are only loaded when
+# they're needed
+HEAVY_MODULES = ['pyparsing', 'kinparse', 'NetlistObjects']
+
+# Modules that must import without the heavy modules
+LIGHT_MODULES = ['KiCadVerilog', 'kicadverilog_action', 'kvgui', 'kvincludes', 'kvserver']
+
+# How long a light module may take to import, in seconds. It's generous, so the test only
+# fails if something heavy starts being imported
+LIGHT_IMPORT_BUDGET = 1.0
+
+# Import a module in a fresh interpreter. Returns how long the import took, and which
+# of the heavy modules it loaded
+def import_module(module):
+    script = ('import json, sys, time\n'
+              'start = time.perf_counter()\n'
+              'import ' + module + '\n'
+              'elapsed = time.perf_counter() - start\n'
+              'print(json.dumps({"time": elapsed, "loaded": [name for name in ' + repr(HEAVY_MODULES) +
+              ' if name in sys.modules]}))\n')
+    env = dict(os.environ, PYTHONPATH = PLUGINS_DIR)
+    output = subprocess.run([sys.executable, '-c', script], env = env, cwd = PLUGINS_DIR,
+                            stdout = subprocess.PIPE, check = True).stdout
+    return json.loads(output)
+
+@pytest.mark.parametrize('module', MODULES)
+def test_import_time(module, record_property):
+    requirement = REQUIRES.get(module)
+    if requirement != None and importlib.util.find_spec(requirement) == None:
+        pytest.skip(module + ' needs ' + requirement)
+
+    result = import_module(module)
+    record_property('import_time', result['time'])
+    print(module + ' imported in {:.3f}s'.format(result['time']))
+
+    if module in LIGHT_MODULES:
+        assert result['loaded'] == [], module + ' imported ' + ', '.join(result['loaded'])
+        assert result['time'] < LIGHT_IMPORT_BUDGET
+
+# kvgui needs wx to import, so also check its source: the heavy modules, and KiCadVerilog
+# (which loads them), may only be imported inside functions
+@pytest.mark.parametrize('module', ['kvgui', 'kicadverilog_action'])
+def test_no_module_level_parser_imports(module):
+    with open(os.path.join(PLUGINS_DIR, module + '.py'), 'r', encoding='utf-8') as source:
+        tree = ast.parse(source.read())
+
+    # Look at the module level statements, including those in if and try blocks, but not
+    # the bodies of functions and classes
+    imported = []
+    pending = list(tree.body)
+    while len(pending):
+        node = pending.pop()
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            continue
+        pending.extend(ast.iter_child_nodes(node))
+        if isinstance(node, ast.Import):
+            imported += [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom):
+            imported += [node.module or ''] + [alias.name for alias in node.names]
+    assert not set(imported) & set(HEAVY_MODULES + ['KiCadVerilog', 'kvgui'])